@@ -6,35 +6,130 @@ The script takes an input PDF file path as an argument and produces a Markdown
 file in the same directory with the same name as the PDF file.
 """
 import argparse
+import asyncio
 import base64
+import functools
+import hashlib
 import io
+import json
 import os
+import re
 import sys
+import tempfile
+import threading
+import time
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    NotFoundError,
+    OpenAI,
+    RateLimitError,
+)
 from pdf2image import convert_from_path
 from PIL import Image
-from PyPDF2 import PdfReader
+import pypdfium2 as pdfium
 from tenacity import (
     retry,
+    retry_if_exception_type,
     stop_after_attempt,
     wait_random_exponential,
 )
 from tqdm import tqdm
-from typing import List, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
 
-# Setup OpenAI client
-load_dotenv()
-openai_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=openai_key)
+# OpenAI credentials and clients are set up lazily, once per process, so that
+# worker processes don't each redo it at import time
+@functools.lru_cache(maxsize=1)
+def _get_api_key() -> Union[str, None]:
+    load_dotenv()
+    return os.getenv("OPENAI_API_KEY")
 
 
-def pdf_to_markdown(
+@functools.lru_cache(maxsize=1)
+def get_client() -> OpenAI:
+    """
+    Get this process's OpenAI client, creating it on first use.
+
+    The client reuses pooled HTTP/2 connections across requests.
+    """
+    return OpenAI(
+        api_key=_get_api_key(),
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100, max_keepalive_connections=50
+            )
+        )
+    )
+
+
+# Pages are rendered at RENDER_DPI and downscaled so their long edge is at most
+# MAX_IMAGE_SIZE pixels, the most GPT-4o makes use of
+RENDER_DPI = 150
+MAX_IMAGE_SIZE = 2048
+
+# Images sent with "low" detail are billed as a flat 512x512 tile, so there's
+# no point sending more than LOW_DETAIL_IMAGE_SIZE pixels on the long edge
+LOW_DETAIL_IMAGE_SIZE = 512
+
+# OpenAI rejects images over 20 MB, so encoded images are kept under this
+MAX_IMAGE_PAYLOAD = 18 * 1024 * 1024
+
+# GPT-4o prompts, built once. The 'vt' prompt has a {prior_text} placeholder
+# that is filled in with str.replace, so braces in the text are left alone.
+_VISION_BASE = (
+    "Write a Markdown version of this page keeping as much of the semantic "
+    "meaning from information hierarchy as possible. For tabular-like "
+    "data (including chart data), make easy to read tables as they'd be "
+    "presented by a financial analyst.\n\n"
+    "DO NOT include any 'meta description' of the markdown itself, like:"
+    "\n- 'In the tables, the data should reflect the values provided in the"
+    " original image.'"
+    "\n- 'This markdown version maintains the hierarchy and clarity of the "
+    "original page using headers and tables to present the financial data "
+    "in an analyst-friendly format.'"
+    "\n- 'In this Markdown version, the hierarchy of information is "
+    "preserved with headers (`#`, `##`, `###`) and tables are created for"
+    "easier readability as per the data presented.'\n"
+    "Do NOT start each page with ```markdown or end with ```."
+)
+
+_VISION_ASSIST = (
+    "\n\nYour vision isn't great, so I've provided previously extracted "
+    "text to help in <prior_text> tags. That text isn't perfect either so "
+    "use a balanced approach to create the full Markdown output.\n"
+    "\n<prior_text>\n{prior_text}\n</prior_text>\n"
+)
+
+_PROMPT_V = _VISION_BASE
+_PROMPT_VT_TEMPLATE = _VISION_BASE + _VISION_ASSIST
+
+# Part of the response cache key. Bump this whenever the prompts above change
+# so cached responses are not reused.
+PROMPT_VERSION = "2"
+
+# OpenAI Batch API limits per input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+
+
+async def pdf_to_markdown(
         pdf_path: str, 
         output_dir: str,
         mode: str = "vt",
-        verbose: bool = True
+        verbose: bool = True,
+        max_concurrency: int = 10,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 30000,
+        detail_threshold: int = 2000,
+        render_workers: Union[int, None] = None
     ) -> str:
     """
     Main function to convert a PDF to Markdown using GPT-4o visual reasoning.
@@ -47,113 +142,837 @@ def pdf_to_markdown(
     located in the output directory. If verbose is True, it also prints the 
     markdown text to the screen.
 
+    Pages are processed as a pipeline: pages are rasterized, and their prior 
+    text extracted, in a thread pool and queued as they finish, while 
+    `max_concurrency` workers take pages off the queue, encode them and send 
+    them to GPT-4o. Requests are held under the given request and token rate 
+    limits. Each page's Markdown is written to the output file as soon as 
+    all pages before it are done, so the output is in page order. Pages are 
+    only started within a fixed window past the first unwritten page, so 
+    memory use stays bounded even while a page is being retried. Responses 
+    are cached on disk, so rerunning on the same PDF (including after a 
+    crash) only sends pages that weren't done yet.
+
     Args:
         pdf_path: The path to the input PDF file.
         output_dir: The directory where the output markdown file will be saved.
         mode: The processing mode ('v' for vision-only, 'vt' for 
             vision-and-text).
         verbose: If True, print the markdown text to the screen.
+        max_concurrency: The maximum number of concurrent GPT-4o requests.
+        requests_per_minute: The OpenAI requests-per-minute limit to stay under.
+        tokens_per_minute: The OpenAI tokens-per-minute limit to stay under.
+        detail_threshold: Pages with more than this many characters of prior 
+            text are sent as a low detail image (see `_get_image_detail`).
+        render_workers: Optional; the number of pages to rasterize at once. 
+            Defaults to the number of CPUs.
 
     Returns:
         output_file_path
     """
-    # Setup constants and validation
-    output_file_name = os.path.basename(pdf_path).rsplit('.', 1)[0] + '.md'
-    output_file_path = os.path.join(output_dir, output_file_name)
-    pdf_file_name = os.path.basename(pdf_path)
+    output_file_path = _get_output_file_path(pdf_path, output_dir)
+    _validate_mode(mode)
 
-    # Validate mode
-    valid_modes = ['v', 'vt']
-    if mode not in valid_modes:
-        raise ValueError(
-            f"Invalid mode '{mode}'. Valid modes are {valid_modes}."
-        )
+    # Prior texts are extracted page by page as the pages are rendered, rather
+    # than all up front. pdfium isn't thread safe, so access is locked.
+    pdf = pdfium.PdfDocument(pdf_path)
+    pdf_lock = threading.Lock()
+    num_pages = len(pdf)
 
-    # Get images
-    images = _pdf_to_images_with_storage(pdf_path, output_dir)
+    def extract_prior_text(ix: int) -> str:
+        with pdf_lock:
+            return _extract_page_text(pdf, ix)
 
-    # Get prior texts
-    if mode == 'v':
-        prior_texts = [None] * len(images)
-    elif mode == 'vt':
-        prior_texts = _get_prior_text(pdf_path)
+    # Build the markdown
+    loop = asyncio.get_running_loop()
+    num_render_workers = render_workers or os.cpu_count() or 1
+    render_executor = ThreadPoolExecutor(max_workers=num_render_workers)
+    # Share pooled HTTP/2 connections across the concurrent page requests so
+    # they don't each pay for a TLS handshake. The client's own retries are
+    # off; `_process_image_with_gpt4` retries, so every attempt goes through
+    # the rate limiter
+    aclient = AsyncOpenAI(
+        api_key=_get_api_key(),
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=64, max_keepalive_connections=32
+            ),
+            timeout=120.0
+        )
+    )
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    cache = ResponseCache(_get_cache_path(pdf_path, output_dir))
+    queue = asyncio.Queue(maxsize=8)
+    page_indices = iter(range(num_pages))
+    writer = MarkdownWriter(pdf_path, output_file_path, verbose)
+    progress = tqdm(total=num_pages)
+    # Pages finished early are held by the writer until the pages before them
+    # are done. Don't start a page more than this far past the first unwritten
+    # one, so a page stuck in retries can't leave the rest of the PDF held in
+    # memory. The window still covers every page that can be in flight.
+    max_pages_ahead = (
+        2 * max_concurrency + num_render_workers + queue.maxsize
+    )
+    written = asyncio.Condition()
 
-    # Check that lengths match
-    if len(prior_texts) != len(images):
-        raise ValueError(
-            f"The number of prior texts ({len(prior_texts)}) does not match "
-            f"the number of images ({len(images)})."
+    async def produce():
+        # Each producer renders the next unclaimed page until none are left
+        for ix in page_indices:
+            async with written:
+                await written.wait_for(
+                    lambda: ix < writer.next_page_index + max_pages_ahead
+                )
+            image = await loop.run_in_executor(
+                render_executor, _render_page_with_storage,
+                pdf_path, output_dir, ix
+            )
+            prior_text = None
+            if mode == 'vt':
+                prior_text = await loop.run_in_executor(
+                    render_executor, extract_prior_text, ix
+                )
+            await queue.put((ix, image, prior_text))
+
+    async def produce_all():
+        await asyncio.gather(
+            *[produce() for _ in range(num_render_workers)]
         )
+        for _ in range(max_concurrency):
+            await queue.put(None)
 
-    # Build the markdown
-    markdown_content = []
-    for ix, (image, prior_text) in enumerate(tqdm(zip(images, prior_texts))):
-        image_base64 = _pdf_image_to_base64_str(image)
-        markdown_text = _process_image_with_gpt4(image_base64, prior_text)
-        markdown_text = (
-            f"File: {pdf_file_name}; Page: {ix + 1}\n"
-         ) + markdown_text
-        markdown_content.append(markdown_text)
-        if verbose:
-            print(markdown_text)
-
-    # Write results
-    with open(output_file_path, 'w') as file:
-        file.write('\n'.join(markdown_content))
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            ix, image, prior_text = item
+            detail = _get_image_detail(prior_text, detail_threshold)
+            image_base64 = await loop.run_in_executor(
+                None, _pdf_image_to_base64_str, image, _get_max_size(detail)
+            )
+            image.close()
+            markdown_text = await _process_image_with_gpt4(
+                aclient, image_base64, prior_text, limiter, cache, detail
+            )
+            writer.write(ix, markdown_text)
+            async with written:
+                written.notify_all()
+            progress.update(1)
+
+    tasks = [asyncio.create_task(produce_all())] + [
+        asyncio.create_task(consume()) for _ in range(max_concurrency)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        progress.close()
+        writer.close()
+        render_executor.shutdown(wait=False, cancel_futures=True)
+        # Also closes the underlying httpx client
+        await aclient.close()
+        with pdf_lock:
+            pdf.close()
 
     return output_file_path
 
 
+def pdf_to_markdown_batch(
+        pdf_path: str,
+        output_dir: str,
+        mode: str = "vt",
+        verbose: bool = True,
+        poll_interval: float = 60,
+        detail_threshold: int = 2000
+    ) -> str:
+    """
+    Convert a PDF to Markdown using the OpenAI Batch API.
+
+    See `pdfs_to_markdown_batch`, which this calls with a single PDF.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output markdown file will be saved.
+        mode: The processing mode ('v' for vision-only, 'vt' for 
+            vision-and-text).
+        verbose: If True, print the markdown text to the screen.
+        poll_interval: The number of seconds to wait between batch status 
+            checks.
+        detail_threshold: Pages with more than this many characters of prior 
+            text are sent as a low detail image (see `_get_image_detail`).
+
+    Returns:
+        output_file_path
+    """
+    return pdfs_to_markdown_batch(
+        [pdf_path], [output_dir], mode, verbose, poll_interval,
+        detail_threshold
+    )[0]
+
+
+def pdfs_to_markdown_batch(
+        pdf_paths: List[str],
+        output_dirs: List[str],
+        mode: str = "vt",
+        verbose: bool = True,
+        poll_interval: float = 60,
+        detail_threshold: int = 2000
+    ) -> List[str]:
+    """
+    Convert several PDFs to Markdown using the OpenAI Batch API.
+
+    Builds the same GPT-4o request as `pdf_to_markdown` for every page of 
+    every PDF and submits them together, so all PDFs share one round of batch 
+    jobs and one polling loop. Batch jobs are billed at half price and use a 
+    separate rate limit pool, at the cost of a completion window of up to 24 
+    hours. Pages with a cached response are not submitted.
+
+    If some requests fail, every successful response is still cached and the 
+    PDFs that are complete are still written before an error is raised, so a 
+    rerun only pays for the failed pages. Submitted jobs are recorded next to 
+    each PDF's cache (see `_get_batch_state_path`) until their results are 
+    cached, so if the wait is interrupted, the next run picks up those jobs' 
+    results instead of submitting the pages again.
+
+    Args:
+        pdf_paths: The paths to the input PDF files.
+        output_dirs: The directory where each PDF's markdown file will be 
+            saved.
+        mode: The processing mode ('v' for vision-only, 'vt' for 
+            vision-and-text).
+        verbose: If True, print the markdown text to the screen.
+        poll_interval: The number of seconds to wait between batch status 
+            checks.
+        detail_threshold: Pages with more than this many characters of prior 
+            text are sent as a low detail image (see `_get_image_detail`).
+
+    Returns:
+        The output file paths, in the same order as `pdf_paths`.
+
+    Raises:
+        RuntimeError: If any page request failed, after the complete PDFs 
+            have been written.
+    """
+    caches = [
+        ResponseCache(_get_cache_path(pdf_path, output_dir))
+        for pdf_path, output_dir in zip(pdf_paths, output_dirs)
+    ]
+    state_paths = [
+        _get_batch_state_path(pdf_path, output_dir)
+        for pdf_path, output_dir in zip(pdf_paths, output_dirs)
+    ]
+
+    # Cache the results of jobs left by an earlier run that was interrupted
+    # while waiting on them. Their pages are then skipped below.
+    resumed = {}
+    resumed_keys = {}
+    for pdf_ix, state_path in enumerate(state_paths):
+        for batch_id, keys in _load_batch_state(state_path).items():
+            resumed.setdefault(batch_id, []).extend(keys)
+            for custom_id, cache_key in keys.items():
+                resumed_keys[custom_id] = (pdf_ix, cache_key)
+    if resumed:
+        responses, _ = _wait_for_batches(resumed, poll_interval)
+        for custom_id, markdown_text in responses.items():
+            pdf_ix, cache_key = resumed_keys[custom_id]
+            caches[pdf_ix].put(cache_key, markdown_text)
+        for state_path in state_paths:
+            if os.path.exists(state_path):
+                os.remove(state_path)
+
+    results = []
+    pending = {}
+
+    def build_requests():
+        # Requests are built lazily so only one page image is held at a time
+        for pdf_ix, (pdf_path, output_dir) in enumerate(
+                zip(pdf_paths, output_dirs)):
+            image_paths, prior_texts = _load_pages(pdf_path, output_dir, mode)
+            cache = caches[pdf_ix]
+            results.append([None] * len(image_paths))
+            pdf_sha = hashlib.sha256(pdf_path.encode('utf-8')).hexdigest()[:16]
+            pages = enumerate(zip(image_paths, prior_texts))
+            for ix, (image_path, prior_text) in pages:
+                detail = _get_image_detail(prior_text, detail_threshold)
+                with Image.open(image_path) as image:
+                    image_base64 = _pdf_image_to_base64_str(
+                        image, _get_max_size(detail)
+                    )
+                cache_key = ResponseCache.key(image_base64, prior_text, detail)
+                results[pdf_ix][ix] = cache.get(cache_key)
+                if results[pdf_ix][ix] is not None:
+                    continue
+                custom_id = f"{pdf_sha}:{ix}"
+                pending[custom_id] = (pdf_ix, ix, cache_key)
+                yield {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": _build_gpt4_request(
+                        image_base64, prior_text, detail
+                    )
+                }
+
+    def record_batch(batch_id: str, custom_ids: List[str]):
+        # Record the job with each PDF it has pages of, before waiting on it
+        keys_by_pdf = {}
+        for custom_id in custom_ids:
+            pdf_ix, _, cache_key = pending[custom_id]
+            keys_by_pdf.setdefault(pdf_ix, {})[custom_id] = cache_key
+        for pdf_ix, keys in keys_by_pdf.items():
+            state = _load_batch_state(state_paths[pdf_ix])
+            state[batch_id] = keys
+            _save_batch_state(state_paths[pdf_ix], state)
+
+    responses, failures = _submit_batch(
+        build_requests(), poll_interval, record_batch
+    )
+    for custom_id, markdown_text in responses.items():
+        pdf_ix, ix, cache_key = pending[custom_id]
+        caches[pdf_ix].put(cache_key, markdown_text)
+        results[pdf_ix][ix] = markdown_text
+    # Every result is cached now, so the jobs needn't be picked up again
+    for state_path in state_paths:
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    output_file_paths = []
+    for pdf_path, output_dir, pdf_results in zip(
+            pdf_paths, output_dirs, results):
+        if None in pdf_results:
+            continue
+        output_file_path = _get_output_file_path(pdf_path, output_dir)
+        _write_markdown(pdf_path, output_file_path, pdf_results, verbose)
+        output_file_paths.append(output_file_path)
+
+    if failures:
+        failed_pages = []
+        for custom_id, reason in failures.items():
+            pdf_ix, ix, _ = pending[custom_id]
+            failed_pages.append(
+                f"{pdf_paths[pdf_ix]} page {ix + 1}: {reason}"
+            )
+        raise RuntimeError(
+            f"Batch requests failed for {len(failures)} page(s); the other "
+            f"pages were cached and complete PDFs were written:\n"
+            + '\n'.join(failed_pages)
+        )
+
+    return output_file_paths
+
+
+def _submit_batch(
+        requests: Iterable[dict],
+        poll_interval: float = 60,
+        on_submit: Union[Callable[[str, List[str]], None], None] = None
+    ) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Submit chat completion requests as OpenAI batch jobs and wait for the 
+    results.
+
+    The requests are written to temporary JSONL files, split so each stays 
+    under the Batch API's per-file limits, and each file is uploaded and run 
+    as a batch job with a 24 hour completion window. All jobs are then waited 
+    on together with `_wait_for_batches`.
+
+    Args:
+        requests: Batch request lines, each with a unique `custom_id`.
+        poll_interval: The number of seconds to wait between status checks.
+        on_submit: Optional; called with the id of each batch job and the 
+            `custom_id`s of its requests as soon as the job is created.
+
+    Returns:
+        See `_wait_for_batches`. Both dicts are empty if there were no 
+        requests.
+    """
+    client = get_client()
+    custom_ids = []
+    batch_custom_ids = {}
+    num_written = 0
+    for batch_file_path in _write_batch_files(requests, custom_ids):
+        # Ids are appended as lines are written, so the new ones are this file's
+        ids = custom_ids[num_written:]
+        num_written = len(custom_ids)
+        try:
+            with open(batch_file_path, 'rb') as file:
+                batch_input_file = client.files.create(
+                    file=file, purpose="batch"
+                )
+        finally:
+            os.remove(batch_file_path)
+        batch = client.batches.create(
+            input_file_id=batch_input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        batch_custom_ids[batch.id] = ids
+        if on_submit is not None:
+            on_submit(batch.id, ids)
+
+    return _wait_for_batches(batch_custom_ids, poll_interval)
+
+
+def _wait_for_batches(
+        batch_custom_ids: Dict[str, List[str]],
+        poll_interval: float = 60
+    ) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Wait for OpenAI batch jobs to finish and read their results.
+
+    All jobs are polled together every `poll_interval` seconds until they 
+    finish. Results are read from each job's output and error files, 
+    including jobs that did not complete, so a failure never discards 
+    responses that were already returned.
+
+    Args:
+        batch_custom_ids: Maps the id of each batch job to the `custom_id`s 
+            of the requests it was submitted with.
+        poll_interval: The number of seconds to wait between status checks.
+
+    Returns:
+        A tuple of two dicts. The first maps the `custom_id` of each 
+        successful request to the Markdown returned by GPT-4o; the second maps 
+        the `custom_id` of each failed or missing request to the reason.
+    """
+    client = get_client()
+    batches = []
+    failures = {}
+    for batch_id, ids in batch_custom_ids.items():
+        try:
+            batches.append(client.batches.retrieve(batch_id))
+        except NotFoundError:
+            for custom_id in ids:
+                failures[custom_id] = f"batch '{batch_id}' not found"
+
+    terminal_statuses = ('completed', 'failed', 'expired', 'cancelled')
+    while any(batch.status not in terminal_statuses for batch in batches):
+        time.sleep(poll_interval)
+        batches = [
+            batch if batch.status in terminal_statuses
+            else client.batches.retrieve(batch.id)
+            for batch in batches
+        ]
+
+    responses = {}
+    for batch in batches:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            output = client.files.content(file_id).text
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    failures[result["custom_id"]] = _describe_batch_error(
+                        result
+                    )
+                    continue
+                message = response["body"]["choices"][0]["message"]
+                responses[result["custom_id"]] = message["content"]
+
+        for custom_id in batch_custom_ids[batch.id]:
+            if custom_id not in responses and custom_id not in failures:
+                failures[custom_id] = (
+                    f"no result; batch '{batch.id}' finished with status "
+                    f"'{batch.status}'"
+                )
+
+    return responses, failures
+
+
+def _describe_batch_error(result: dict) -> str:
+    """
+    Describe why a line of a batch output or error file failed.
+
+    Args:
+        result: A parsed line of a batch output or error file.
+
+    Returns:
+        A short description of the error.
+    """
+    error = result.get("error")
+    if not error:
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        error = body.get("error") or {
+            "message": f"HTTP status {response.get('status_code')}"
+        }
+    code = error.get("code")
+    message = error.get("message")
+    return f"{code}: {message}" if code else str(message)
+
+
+def _write_batch_files(
+        requests: Iterable[dict],
+        custom_ids: List[str]
+    ) -> Iterator[str]:
+    """
+    Write batch requests to temporary JSONL files within the Batch API limits.
+
+    A new file is started whenever the next request would take the current 
+    one past BATCH_MAX_REQUESTS lines or BATCH_MAX_BYTES bytes. Each file is 
+    yielded once it is complete; the caller is responsible for removing it.
+
+    Args:
+        requests: Batch request lines, each with a unique `custom_id`.
+        custom_ids: A list that the `custom_id` of every request written is 
+            appended to.
+
+    Returns:
+        An iterator over the paths of the written files.
+    """
+    file = None
+    num_requests = num_bytes = 0
+    for request in requests:
+        line = (json.dumps(request) + '\n').encode('utf-8')
+        if file is not None and (
+                num_requests >= BATCH_MAX_REQUESTS
+                or num_bytes + len(line) > BATCH_MAX_BYTES):
+            file.close()
+            yield file.name
+            file = None
+        if file is None:
+            file = tempfile.NamedTemporaryFile(
+                'wb', suffix='.jsonl', delete=False
+            )
+            num_requests = num_bytes = 0
+        file.write(line)
+        num_requests += 1
+        num_bytes += len(line)
+        custom_ids.append(request["custom_id"])
+    if file is not None:
+        file.close()
+        yield file.name
+
+
+class RateLimiter:
+    """
+    Token bucket limiter for OpenAI requests-per-minute and tokens-per-minute.
+
+    Both buckets start full and refill continuously at their per-minute rate. 
+    A request waits until there is capacity for one more request and for its 
+    estimated number of tokens. Adapted from the openai-cookbook 
+    `api_request_parallel_processor.py` example.
+
+    Args:
+        requests_per_minute: The maximum number of requests per minute. Must 
+            be at least 1, or the bucket could never hold a whole request.
+        tokens_per_minute: The maximum number of tokens per minute.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        if requests_per_minute < 1:
+            raise ValueError(
+                "requests_per_minute must be at least 1, "
+                f"got {requests_per_minute}."
+            )
+        if tokens_per_minute <= 0:
+            raise ValueError(
+                f"tokens_per_minute must be positive, got {tokens_per_minute}."
+            )
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_request_capacity = requests_per_minute
+        self.available_token_capacity = tokens_per_minute
+        self.last_update_time = time.monotonic()
+
+    async def acquire(self, estimated_tokens: float):
+        """
+        Wait until there is capacity for a request, then consume it.
+
+        Args:
+            estimated_tokens: The estimated number of tokens the request uses.
+        """
+        # A request larger than the bucket would otherwise wait forever
+        estimated_tokens = min(estimated_tokens, self.tokens_per_minute)
+        while True:
+            now = time.monotonic()
+            elapsed = now - self.last_update_time
+            self.available_request_capacity = min(
+                self.available_request_capacity
+                + elapsed * self.requests_per_minute / 60,
+                self.requests_per_minute
+            )
+            self.available_token_capacity = min(
+                self.available_token_capacity
+                + elapsed * self.tokens_per_minute / 60,
+                self.tokens_per_minute
+            )
+            self.last_update_time = now
+
+            if (
+                self.available_request_capacity >= 1
+                and self.available_token_capacity >= estimated_tokens
+            ):
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= estimated_tokens
+                return
+            await asyncio.sleep(0.001)
+
+
+class ResponseCache:
+    """
+    On-disk cache of GPT-4o responses for the pages of a PDF.
+
+    Entries are stored one per line as JSON in an append-only file, so every 
+    response is saved as soon as it arrives. Keys are derived from the page 
+    image, the prior text, the image detail and PROMPT_VERSION (see 
+    `ResponseCache.key`). If the process was killed partway through writing 
+    an entry, the partial last line is cut off when the cache is loaded, and 
+    that page is simply requested again.
+
+    Args:
+        path: The path of the JSONL cache file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'rb+') as file:
+                data = file.read()
+                # Drop an unterminated last line, so the next entry isn't
+                # appended onto it
+                end = data.rfind(b'\n') + 1
+                if end < len(data):
+                    file.truncate(end)
+            for line in data[:end].decode('utf-8').splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.entries[entry["key"]] = entry["markdown"]
+
+    @staticmethod
+    def key(
+            image_base64: str,
+            prior_text: Union[str, None] = None,
+            detail: str = "high"
+        ) -> str:
+        """
+        Compute the cache key of a page request.
+
+        Args:
+            image_base64: The base64-encoded image of the page.
+            prior_text: Optional; previously extracted text to provide context.
+            detail: The image detail level ('low' or 'high').
+
+        Returns:
+            A SHA-256 hex digest.
+        """
+        return hashlib.sha256(
+            image_base64.encode('ascii')
+            + (prior_text or '').encode('utf-8')
+            + detail.encode('utf-8')
+            + PROMPT_VERSION.encode('utf-8')
+        ).hexdigest()
+
+    def get(self, key: str) -> Union[str, None]:
+        """
+        Return the cached Markdown for `key`, or None if there isn't any.
+        """
+        return self.entries.get(key)
+
+    def put(self, key: str, markdown_text: str):
+        """
+        Cache the Markdown for `key` and append it to the cache file.
+        """
+        self.entries[key] = markdown_text
+        with open(self.path, 'a') as file:
+            file.write(json.dumps({"key": key, "markdown": markdown_text}) + '\n')
+
+
+class MarkdownWriter:
+    """
+    Writes each page's Markdown to the output file in page order as it 
+    arrives.
+
+    Pages may be written in any order. A page that arrives early is held 
+    until all pages before it have been written, then it is labelled with its 
+    file and page number, written and flushed.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_file_path: The path of the Markdown file to write.
+        verbose: If True, also print the markdown text to the screen.
+    """
+
+    def __init__(
+            self,
+            pdf_path: str,
+            output_file_path: str,
+            verbose: bool = True
+        ):
+        self.pdf_file_name = os.path.basename(pdf_path)
+        self.file = open(output_file_path, 'w')
+        self.verbose = verbose
+        self.next_page_index = 0
+        self.pending = {}
+
+    def write(self, page_index: int, markdown_text: str):
+        """
+        Write the Markdown of a page, along with any held pages it unblocks.
+
+        Args:
+            page_index: The zero-based index of the page.
+            markdown_text: The Markdown of the page.
+        """
+        self.pending[page_index] = markdown_text
+        while self.next_page_index in self.pending:
+            markdown_text = (
+                f"File: {self.pdf_file_name}; "
+                f"Page: {self.next_page_index + 1}\n"
+            ) + self.pending.pop(self.next_page_index)
+            if self.next_page_index > 0:
+                self.file.write('\n')
+            self.file.write(markdown_text)
+            self.file.flush()
+            if self.verbose:
+                print(markdown_text)
+            self.next_page_index += 1
+
+    def close(self):
+        """
+        Close the output file.
+        """
+        self.file.close()
+
+
+def _estimate_tokens(request: dict) -> float:
+    """
+    Roughly estimate the tokens OpenAI counts against the TPM limit for a page 
+    request.
+
+    Like the openai-cookbook's `num_tokens_consumed_from_request`, this 
+    includes the completion budget (`max_tokens`), which OpenAI reserves when 
+    the request is admitted. On top of that it counts ~765 tokens for a high 
+    detail page image, or 85 for a low detail one, and ~4 characters per 
+    token of prompt text (including any prior text).
+
+    Args:
+        request: The request built by `_build_gpt4_request`.
+
+    Returns:
+        The estimated number of tokens.
+    """
+    text, image = request["messages"][0]["content"]
+    image_tokens = 85 if image["image_url"]["detail"] == "low" else 765
+    return request["max_tokens"] + image_tokens + len(text["text"]) / 4
+
+
+def _get_image_detail(
+        prior_text: Union[str, None],
+        detail_threshold: int
+    ) -> str:
+    """
+    Choose the image detail level for a page.
+
+    Pages with plenty of prior text already give GPT-4o most of the content, 
+    so a low detail image (85 tokens flat) is enough for the layout.
+
+    Args:
+        prior_text: Optional; previously extracted text to provide context.
+        detail_threshold: The number of characters of prior text above which 
+            low detail is used.
+
+    Returns:
+        'low' or 'high'.
+    """
+    if prior_text and len(prior_text) > detail_threshold:
+        return "low"
+    return "high"
+
+
+def _get_max_size(detail: str) -> int:
+    """
+    Get the largest useful long edge, in pixels, for an image detail level.
+    """
+    return LOW_DETAIL_IMAGE_SIZE if detail == "low" else MAX_IMAGE_SIZE
+
+
 @retry(
-        wait=wait_random_exponential(min=1./5000, max=5), 
-        stop=stop_after_attempt(3)
+        wait=wait_random_exponential(min=1, max=60),
+        stop=stop_after_attempt(6),
+        retry=retry_if_exception_type(
+            (
+                RateLimitError, APITimeoutError, APIConnectionError,
+                InternalServerError
+            )
+        )
 )
-def _process_image_with_gpt4(
+async def _process_image_with_gpt4(
+        aclient: AsyncOpenAI,
         image_base64: str, 
-        prior_text: Union[str, None] = None
+        prior_text: Union[str, None] = None,
+        limiter: Union[RateLimiter, None] = None,
+        cache: Union[ResponseCache, None] = None,
+        detail: str = "high"
     ) -> str:
     """
     Send a base64-encoded image to GPT-4o for processing, optionally including
     prior text for context.
 
-    Constructs a prompt for GPT-4o to interpret the image as a Markdown 
-    document, preserving the semantic meaning and information hierarchy, 
-    including tables. If prior text is provided, it is included to assist GPT-4o 
-    in the interpretation.
+    See `_build_gpt4_request` for the prompt sent with the image. If a cache 
+    is given and already holds a response for this page, no request is sent.
 
     Args:
+        aclient: The async OpenAI client used to send the request.
         image_base64: The base64-encoded image to be processed.
         prior_text: Optional; previously extracted text to provide context.
+        limiter: Optional; a rate limiter to wait on before sending the request.
+        cache: Optional; a response cache to check and update.
+        detail: The image detail level ('low' or 'high').
 
     Returns:
         The Markdown version of the image content as interpreted by GPT-4o.
     """
-    vision_base = (
-        "Write a Markdown version of this page keeping as much of the semantic "
-        "meaning from information hierarchy as possible. For tabular-like "
-        "data (including chart data), make easy to read tables as they'd be "
-        "presented by a financial analyst.\n\n"
-        "DO NOT include any 'meta description' of the markdown itself, like:"
-        "\n- 'In the tables, the data should reflect the values provided in the"
-        " original image.'"
-        "\n- 'This markdown version maintains the hierarchy and clarity of the "
-        "original page using headers and tables to present the financial data "
-        "in an analyst-friendly format.'"
-        "\n- 'In this Markdown version, the hierarchy of information is "
-        "preserved with headers (`#`, `##`, `###`) and tables are created for"
-        "easier readability as per the data presented.'\n"
-        "Do NOT start each page with ```markdown or end with ```."
-    )
+    if cache is not None:
+        cache_key = ResponseCache.key(image_base64, prior_text, detail)
+        markdown_text = cache.get(cache_key)
+        if markdown_text is not None:
+            return markdown_text
+    request = _build_gpt4_request(image_base64, prior_text, detail)
+    if limiter is not None:
+        await limiter.acquire(_estimate_tokens(request))
+    response = await aclient.chat.completions.create(**request)
+    markdown_text = response.choices[0].message.content
+    if cache is not None:
+        cache.put(cache_key, markdown_text)
+    return markdown_text
 
-    vision_assist = (
-        "\n\nYour vision isn't great, so I've provided previously extracted "
-        "text to help in <prior_text> tags. That text isn't perfect either so "
-        "use a balanced approach to create the full Markdown output.\n"
-        "\n<prior_text>\n{prior_text}\n</prior_text>\n"
-    )
 
-    prompt = f"{vision_base}{vision_assist}" if prior_text else vision_base
-    response = client.chat.completions.create(
+def _build_gpt4_request(
+        image_base64: str,
+        prior_text: Union[str, None] = None,
+        detail: str = "high"
+    ) -> dict:
+    """
+    Build the GPT-4o chat completion request for a single page.
+
+    Constructs a prompt for GPT-4o to interpret the image as a Markdown 
+    document, preserving the semantic meaning and information hierarchy, 
+    including tables. If prior text is provided, it is included to assist GPT-4o 
+    in the interpretation. The same request body is used for both real-time 
+    and batch requests.
+
+    Args:
+        image_base64: The base64-encoded image to be processed.
+        prior_text: Optional; previously extracted text to provide context.
+        detail: The image detail level ('low' or 'high').
+
+    Returns:
+        The keyword arguments for `chat.completions.create`.
+    """
+    if prior_text:
+        prompt = _PROMPT_VT_TEMPLATE.replace("{prior_text}", prior_text)
+    else:
+        prompt = _PROMPT_V
+    return dict(
         model="gpt-4o",
         messages=[
             {
@@ -166,7 +985,8 @@ def _process_image_with_gpt4(
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"    
+                            "url": f"data:image/jpeg;base64,{image_base64}",
+                            "detail": detail
                         }
                     }
 
@@ -175,45 +995,333 @@ def _process_image_with_gpt4(
         ],
         max_tokens=4096
     )
-    return response.choices[0].message.content
+
+
+def _get_output_file_path(pdf_path: str, output_dir: str) -> str:
+    """
+    Get the path of the Markdown file produced for a PDF.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output markdown file will be saved.
+
+    Returns:
+        The output file path, named after the PDF with a .md extension.
+    """
+    output_file_name = os.path.basename(pdf_path).rsplit('.', 1)[0] + '.md'
+    return os.path.join(output_dir, output_file_name)
+
+
+def _get_cache_path(pdf_path: str, output_dir: str) -> str:
+    """
+    Get the path of the response cache file for a PDF.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output files are saved.
+
+    Returns:
+        The cache file path, next to the PDF's image folder.
+    """
+    base_name = os.path.basename(pdf_path).rsplit('.', 1)[0]
+    return os.path.join(output_dir, base_name + '_cache.jsonl')
+
+
+def _get_batch_state_path(pdf_path: str, output_dir: str) -> str:
+    """
+    Get the path of the file recording a PDF's unfinished batch jobs.
+
+    The file maps the id of each batch job with pages of the PDF to the 
+    `custom_id` and cache key of each of those pages. It only exists while a 
+    `pdfs_to_markdown_batch` run is waiting on the jobs, or after such a run 
+    was interrupted.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output files are saved.
+
+    Returns:
+        The batch state file path, next to the PDF's response cache.
+    """
+    base_name = os.path.basename(pdf_path).rsplit('.', 1)[0]
+    return os.path.join(output_dir, base_name + '_batches.json')
+
+
+def _load_batch_state(path: str) -> Dict[str, Dict[str, str]]:
+    """
+    Load a batch state file (see `_get_batch_state_path`), or return an empty 
+    state if there isn't one.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _save_batch_state(path: str, state: Dict[str, Dict[str, str]]):
+    """
+    Write a batch state file (see `_get_batch_state_path`).
+
+    The state is written to a temporary file and moved into place, so an 
+    interrupted write never leaves a file that can't be loaded.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, path)
+
+
+def _validate_mode(mode: str):
+    """
+    Raise a ValueError if `mode` is not a valid processing mode.
+
+    Args:
+        mode: The processing mode ('v' for vision-only, 'vt' for 
+            vision-and-text).
+    """
+    valid_modes = ['v', 'vt']
+    if mode not in valid_modes:
+        raise ValueError(
+            f"Invalid mode '{mode}'. Valid modes are {valid_modes}."
+        )
+
+
+def _load_pages(
+        pdf_path: str,
+        output_dir: str,
+        mode: str
+    ) -> Tuple[List[str], List[Union[str, None]]]:
+    """
+    Get the page image paths and, in 'vt' mode, the prior text of each page.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output images will be saved.
+        mode: The processing mode ('v' for vision-only, 'vt' for 
+            vision-and-text).
+
+    Returns:
+        A tuple of the page image paths and the prior texts. Prior texts are 
+        all None in 'v' mode.
+    """
+    _validate_mode(mode)
+
+    # Get images
+    image_paths = _pdf_to_images_with_storage(pdf_path, output_dir)
+
+    # Get prior texts
+    if mode == 'v':
+        prior_texts = [None] * len(image_paths)
+    elif mode == 'vt':
+        prior_texts = _get_prior_text(pdf_path)
+
+    # Check that lengths match
+    if len(prior_texts) != len(image_paths):
+        raise ValueError(
+            f"The number of prior texts ({len(prior_texts)}) does not match "
+            f"the number of images ({len(image_paths)})."
+        )
+
+    return image_paths, prior_texts
+
+
+def _write_markdown(
+        pdf_path: str,
+        output_file_path: str,
+        results: List[str],
+        verbose: bool = True
+    ):
+    """
+    Label each page's Markdown with its file and page number and write it out.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_file_path: The path of the Markdown file to write.
+        results: The Markdown for each page, in page order.
+        verbose: If True, print the markdown text to the screen.
+    """
+    writer = MarkdownWriter(pdf_path, output_file_path, verbose)
+    try:
+        for ix, markdown_text in enumerate(results):
+            writer.write(ix, markdown_text)
+    finally:
+        writer.close()
 
 
 def _pdf_to_images_with_storage(
         pdf_path: str, 
         output_dir: str
-    ) -> List[Image.Image]:
+    ) -> List[str]:
     """
-    Load images from the output directory if they exist, otherwise convert the 
+    Find images in the output directory if they exist, otherwise convert the 
     PDF to images and save them to the specified output directory.
 
+    A folder can be missing pages if a `pdf_to_markdown` run, which renders 
+    one page at a time, was interrupted. Missing pages are rendered here, so 
+    there is always exactly one path per page.
+
+    Missing pages are rendered in parallel, one `pdftoppm` process per page, 
+    and each is saved and closed as soon as it's done, so only a few page 
+    images are held in memory at once. Only the paths are returned, so 
+    callers can likewise open one page at a time.
+
     Args:
         pdf_path: The path to the input PDF file.
         output_dir: The directory where the output images will be saved.
 
     Returns:
-        A list of PIL Image objects.
+        A list of image file paths, in page order.
     """
+    image_folder = _get_image_folder(pdf_path, output_dir)
+    os.makedirs(image_folder, exist_ok=True)
+    # Sort by page number, not name, so image_10 comes after image_2.
+    # Folders from older versions hold PNGs; JPEGs win if both exist.
     base_name = os.path.basename(pdf_path).rsplit('.', 1)[0]
-    image_folder = os.path.join(output_dir, base_name + '_images')
-    if not os.path.exists(image_folder):
-        os.makedirs(image_folder)
-        images = convert_from_path(pdf_path)
-        for i, image in enumerate(images):
-            image.save(os.path.join(image_folder, f'{base_name}_image_{i}.png'))
-    else:
-        image_files = sorted(
-            [f for f in os.listdir(image_folder) if f.endswith('.png')],
-            key=lambda x: int(x.rsplit('_', 1)[-1].split('.')[0])
+    pattern = re.compile(
+        rf'{re.escape(base_name)}_image_(\d+)\.(jpg|png)'
+    )
+    page_files = {}
+    for f in os.listdir(image_folder):
+        match = pattern.fullmatch(f)
+        if match:
+            page = int(match.group(1))
+            if not page_files.get(page, '').endswith('.jpg'):
+                page_files[page] = f
+    num_pages = _get_page_count(pdf_path)
+    missing_pages = [i for i in range(num_pages) if i not in page_files]
+
+    def render(page_index: int):
+        _render_page_with_storage(pdf_path, output_dir, page_index).close()
+
+    if missing_pages:
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            list(executor.map(render, missing_pages))
+    return [
+        os.path.join(image_folder, page_files[i]) if i in page_files
+        else _get_image_path(pdf_path, output_dir, i)
+        for i in range(num_pages)
+    ]
+
+
+def _render_page_with_storage(
+        pdf_path: str,
+        output_dir: str,
+        page_index: int
+    ) -> Image.Image:
+    """
+    Load a single page image from the output directory if it exists, otherwise 
+    rasterize the page and save it to the output directory.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output images will be saved.
+        page_index: The zero-based index of the page.
+
+    Returns:
+        A PIL Image object of the page.
+    """
+    image_path = _get_image_path(pdf_path, output_dir, page_index)
+    legacy_image_path = image_path.rsplit('.', 1)[0] + '.png'
+    for path in (image_path, legacy_image_path):
+        if os.path.exists(path):
+            return Image.open(path)
+    image = convert_from_path(
+        pdf_path,
+        first_page=page_index + 1,
+        last_page=page_index + 1,
+        dpi=RENDER_DPI,
+        thread_count=1
+    )[0]
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    _save_page_image(image, image_path)
+    image.close()
+    # Return the saved copy so later runs, which load it from disk, encode the
+    # exact same pixels and hit the response cache
+    return Image.open(image_path)
+
+
+def _save_page_image(image: Image.Image, image_path: str):
+    """
+    Save a rendered page to disk as a JPEG.
+
+    JPEG pages are several times smaller than PNG, so reruns read much less 
+    from disk, and the image is re-encoded as JPEG for GPT-4o anyway.
+
+    The image is written to a temporary file next to `image_path` and then 
+    moved into place, so an interrupted save never leaves a truncated image 
+    that later runs would load.
+
+    Args:
+        image: A PIL Image object of the page.
+        image_path: The path to save the image to.
+    """
+    tmp_path = f"{image_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        image.save(
+            tmp_path, format='JPEG', quality=90, optimize=True,
+            progressive=True
         )
-        images = [
-            Image.open(os.path.join(image_folder, f)) for f in image_files
-        ]
-    return images
+        os.replace(tmp_path, image_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _get_image_folder(pdf_path: str, output_dir: str) -> str:
+    """
+    Get the folder where the page images of a PDF are stored.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output images will be saved.
+
+    Returns:
+        The image folder path.
+    """
+    base_name = os.path.basename(pdf_path).rsplit('.', 1)[0]
+    return os.path.join(output_dir, base_name + '_images')
+
+
+def _get_image_path(pdf_path: str, output_dir: str, page_index: int) -> str:
+    """
+    Get the path where a single page image of a PDF is stored.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+        output_dir: The directory where the output images will be saved.
+        page_index: The zero-based index of the page.
+
+    Returns:
+        The image file path.
+    """
+    base_name = os.path.basename(pdf_path).rsplit('.', 1)[0]
+    return os.path.join(
+        _get_image_folder(pdf_path, output_dir),
+        f'{base_name}_image_{page_index}.jpg'
+    )
+
+
+def _get_page_count(pdf_path: str) -> int:
+    """
+    Get the number of pages in a PDF.
+
+    Args:
+        pdf_path: The path to the input PDF file.
+
+    Returns:
+        The page count.
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
 
 
 def _get_prior_text(pdf_path: str) -> List[str]:
     """
-    Extracts simple text from each page of the PDF using PyPDF2.
+    Extracts simple text from each page of the PDF using pdfium.
 
     Args:
         pdf_path (str): The path to the input PDF file.
@@ -222,26 +1330,112 @@ def _get_prior_text(pdf_path: str) -> List[str]:
         List[str]: A list of strings where each string represents the extracted 
             text from a single page of the PDF.
     """
-    with open(pdf_path, 'rb') as file:
-        reader = PdfReader(file)
-        text_list = [page.extract_text() for page in reader.pages]
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        text_list = [_extract_page_text(pdf, ix) for ix in range(len(pdf))]
+    finally:
+        pdf.close()
     return text_list
 
 
-def _pdf_image_to_base64_str(pdf_page: Image) -> str:
+def _extract_page_text(pdf: pdfium.PdfDocument, page_index: int) -> str:
+    """
+    Extracts simple text from a single page of an open PDF using pdfium.
+
+    Args:
+        pdf (pdfium.PdfDocument): The open PDF document.
+        page_index (int): The zero-based index of the page.
+
+    Returns:
+        str: The extracted text of the page.
+    """
+    page = pdf[page_index]
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+        page.close()
+
+
+def _pdf_image_to_base64_str(
+        pdf_page: Image,
+        max_size: int = MAX_IMAGE_SIZE
+    ) -> str:
     """
     Convert a PDF page to a base64 encoded JPEG image.
 
+    Pages larger than `max_size` on their long edge are downscaled first, 
+    since GPT-4o does not use the extra resolution. If the encoded image is 
+    still over MAX_IMAGE_PAYLOAD, it is re-encoded at lower JPEG qualities and 
+    then at smaller sizes until it fits, since an oversized request would be 
+    rejected on every retry.
+
     Args:
         pdf_page (Image): A PIL Image object representing a PDF page.
+        max_size (int): The maximum long edge of the image, in pixels.
 
     Returns:
         str: A base64 encoded string of the JPEG image.
+
+    Raises:
+        ValueError: If the image doesn't fit even at LOW_DETAIL_IMAGE_SIZE 
+            and the lowest quality.
     """
-    image_buffer = io.BytesIO()
-    pdf_page.save(image_buffer, format='JPEG')
-    byte_data = image_buffer.getvalue()
-    return base64.b64encode(byte_data).decode('utf-8')
+    width, height = pdf_page.size
+    scale = min(1.0, max_size / max(width, height))
+    if scale < 1:
+        pdf_page = pdf_page.resize(
+            (int(width * scale), int(height * scale)), Image.LANCZOS
+        )
+    while True:
+        for quality in (85, 75, 60):
+            # Encode straight from the buffer's memoryview to avoid copying 
+            # the JPEG
+            with io.BytesIO() as image_buffer:
+                pdf_page.save(
+                    image_buffer, format='JPEG', quality=quality,
+                    optimize=True, progressive=True
+                )
+                encoded_size = 4 * ((image_buffer.tell() + 2) // 3)
+                if encoded_size <= MAX_IMAGE_PAYLOAD:
+                    with image_buffer.getbuffer() as byte_data:
+                        return base64.b64encode(byte_data).decode('ascii')
+        width, height = pdf_page.size
+        if max(width, height) <= LOW_DETAIL_IMAGE_SIZE:
+            raise ValueError(
+                f"Page image is still over {MAX_IMAGE_PAYLOAD} bytes when "
+                f"encoded at {width}x{height} and JPEG quality 60."
+            )
+        pdf_page = pdf_page.resize(
+            (int(width * 0.75), int(height * 0.75)), Image.LANCZOS
+        )
+
+
+def process_pdf(
+        pdf_path: str,
+        output_dir: str,
+        processing_mode: str,
+        verbose: bool,
+        max_concurrency: int = 10,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 30000,
+        detail_threshold: int = 2000,
+        render_workers: Union[int, None] = None
+    ):
+    """
+    Convert a single PDF with `pdf_to_markdown` and print the output path.
+
+    Defined at module level so it can be sent to worker processes.
+    """
+    out = asyncio.run(
+        pdf_to_markdown(
+            pdf_path, output_dir, processing_mode, verbose,
+            max_concurrency, requests_per_minute, tokens_per_minute,
+            detail_threshold, render_workers
+        )
+    )
+    print(f"Output file: {out}")
 
 
 if __name__ == "__main__":
@@ -273,6 +1467,30 @@ if __name__ == "__main__":
         dest='verbose',
         help="If set, do not print the markdown text to the screen."
     )
+    parser.add_argument(
+        '-c', '--max_concurrency',
+        type=int,
+        default=10,
+        help="The maximum number of concurrent GPT-4o requests per PDF file (default: 10)."
+    )
+    parser.add_argument(
+        '--rpm',
+        type=float,
+        default=500,
+        help="The OpenAI requests-per-minute limit to stay under (default: 500). With --parallel, it is shared evenly across the worker processes, using fewer workers if needed so each share fits a whole request."
+    )
+    parser.add_argument(
+        '--tpm',
+        type=float,
+        default=30000,
+        help="The OpenAI tokens-per-minute limit to stay under (default: 30000). With --parallel, it is shared evenly across the worker processes, using fewer workers if needed so each share fits a whole request."
+    )
+    parser.add_argument(
+        '--detail_threshold',
+        type=int,
+        default=2000,
+        help="In 'vt' mode, send pages with more than this many characters of extracted text as low detail images, which cost far fewer tokens (default: 2000)."
+    )
     parser.add_argument(
         '-r', '--recursive',
         action='store_true',
@@ -285,56 +1503,98 @@ if __name__ == "__main__":
         default=False,
         help="If set, process each PDF file in parallel when using recursive mode."
     )
+    parser.add_argument(
+        '-b', '--batch',
+        action='store_true',
+        default=False,
+        help="If set, submit the pages of all PDF files together through the OpenAI Batch API (half price, up to 24h turnaround). Requires recursive mode and can't be combined with --parallel."
+    )
     args = parser.parse_args()
+    if args.rpm < 1:
+        parser.error("--rpm must be at least 1")
+    if args.tpm <= 0:
+        parser.error("--tpm must be positive")
+    if args.batch and not args.recursive:
+        parser.error("--batch requires --recursive")
+    if args.batch and args.parallel:
+        parser.error("--batch and --parallel can't be combined")
     target_path = args.target_path
     processing_mode = args.mode
     output_dir = args.output_dir
     verbose = args.verbose
     recursive = args.recursive
     parallel = args.parallel
-
-    def process_pdf(
-            pdf_path: str, output_dir: str, processing_mode: str, verbose: bool
-        ):
-        out = pdf_to_markdown(pdf_path, output_dir, processing_mode, verbose)
-        print(f"Output file: {out}")
+    batch = args.batch
+    max_concurrency = args.max_concurrency
+    requests_per_minute = args.rpm
+    tokens_per_minute = args.tpm
+    detail_threshold = args.detail_threshold
 
     if recursive:
         if not os.path.isdir(target_path):
             print(f"Error: The path '{target_path}' is not a directory.")
             sys.exit(1)
-        if parallel:
-            from concurrent.futures import ThreadPoolExecutor
-            with ThreadPoolExecutor() as executor:
-                futures = []
-                for root, dirs, files in os.walk(target_path):
-                    for file in files:
-                        if file.lower().endswith('.pdf'):
-                            pdf_path = os.path.join(root, file)
-                            output_dir = args.output_dir or \
-                                os.path.dirname(pdf_path)
-                            futures.append(
-                                executor.submit(
-                                    process_pdf, 
-                                    pdf_path, output_dir, processing_mode, 
-                                    verbose
-                                )
-                            )
+        pdf_paths = []
+        output_dirs = []
+        for root, dirs, files in os.walk(target_path):
+            for file in files:
+                if file.lower().endswith('.pdf'):
+                    pdf_path = os.path.join(root, file)
+                    pdf_paths.append(pdf_path)
+                    output_dirs.append(
+                        args.output_dir or os.path.dirname(pdf_path)
+                    )
+
+        if batch:
+            outs = pdfs_to_markdown_batch(
+                pdf_paths, output_dirs, processing_mode, verbose,
+                detail_threshold=detail_threshold
+            )
+            for out in outs:
+                print(f"Output file: {out}")
+        elif parallel:
+            # The workers all draw on the same OpenAI account and CPUs, so
+            # split the rate limits and render threads between them rather
+            # than giving each worker the full budget. Use fewer workers if
+            # needed so each share still fits a whole request; the limiter
+            # lets an oversized request through once a minute regardless.
+            num_cpus = os.cpu_count() or 1
+            tokens_per_request = _estimate_tokens(_build_gpt4_request(""))
+            num_workers = max(1, min(
+                num_cpus,
+                len(pdf_paths),
+                int(requests_per_minute),
+                int(tokens_per_minute // tokens_per_request)
+            ))
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = [
+                    executor.submit(
+                        process_pdf,
+                        pdf_path, output_dir, processing_mode, verbose,
+                        max_concurrency,
+                        requests_per_minute / num_workers,
+                        tokens_per_minute / num_workers,
+                        detail_threshold,
+                        max(1, num_cpus // num_workers)
+                    )
+                    for pdf_path, output_dir in zip(pdf_paths, output_dirs)
+                ]
                 for future in futures:
                     future.result()
         else:
-            for root, dirs, files in os.walk(target_path):
-                for file in files:
-                    if file.lower().endswith('.pdf'):
-                        pdf_path = os.path.join(root, file)
-                        output_dir = args.output_dir or \
-                            os.path.dirname(pdf_path)
-                        process_pdf(
-                            pdf_path, output_dir, processing_mode, verbose
-                        )
+            for pdf_path, output_dir in zip(pdf_paths, output_dirs):
+                process_pdf(
+                    pdf_path, output_dir, processing_mode, verbose,
+                    max_concurrency, requests_per_minute, tokens_per_minute,
+                    detail_threshold
+                )
     else:
         if not os.path.isfile(target_path):
             print(f"Error: The file '{target_path}' does not exist.")
             sys.exit(1)
         output_dir = args.output_dir or os.path.dirname(target_path)
-        process_pdf(target_path, output_dir, processing_mode, verbose)
+        process_pdf(
+            target_path, output_dir, processing_mode, verbose,
+            max_concurrency, requests_per_minute, tokens_per_minute,
+            detail_threshold
+        )